@@ -2,10 +2,12 @@
 import os, time, datetime, re
 import logging
 import csv
-from collections import namedtuple
+from collections import namedtuple, deque
 
+import numpy as np
 from lxml import etree
-from svgpathparse import parsePath
+from svgpathparse import parsePath, parseStyleCached, parseStyleSheet, \
+    extractBoundingBox, _mergeBoundingBox, FLOAT_RE
 
 logging.basicConfig(format='%(asctime)s %(levelname)-5.5s %(message)s')
 
@@ -29,22 +31,261 @@ def pascal_row(n):
         result.extend(reversed(result))
     return result
 
-def make_bezier(xys):
-    # xys should be a sequence of 2-tuples (Bezier control points)
-    n = len(xys)
-    combinations = pascal_row(n-1)
-    def bezier(ts):
-        # This uses the generalized formula for bezier curves
-        # http://en.wikipedia.org/wiki/B%C3%A9zier_curve#Generalization
-        result = []
-        for t in ts:
-            tpowers = (t**i for i in range(n))
-            upowers = reversed([(1-t)**i for i in range(n)])
-            coefs = [c*a*b for c, a, b in zip(combinations, tpowers, upowers)]
-            result.append(
-                tuple(sum([coef*p for coef, p in zip(coefs, ps)]) for ps in zip(*xys)))
-        return result
-    return bezier
+def bezier_points(xys, ts):
+    # Evaluates the bezier curve with control points xys at all ts at once
+    xys = np.asarray(xys, dtype=float)
+    n = len(xys) - 1
+    ts = np.asarray(ts, dtype=float)[:, None]
+    powers = np.arange(n + 1)
+    basis = np.array(pascal_row(n), dtype=float) * ts ** powers * (1 - ts) ** powers[::-1]
+    return basis.dot(xys)
+
+def arc_points(start, rx, ry, rotation, large_arc, sweep, end, ts):
+    # Samples an svg elliptical arc after converting it from endpoint to
+    # center parameterization (SVG 1.1 implementation notes F.6.5). The
+    # ts are reused once per quarter turn so arcs are sampled as densely as
+    # cubic segments.
+    (x1, y1), (x2, y2) = start, end
+    if (x1, y1) == (x2, y2):
+        return np.zeros((0, 2))
+    rx, ry = abs(rx), abs(ry)
+    if rx == 0 or ry == 0:
+        return np.array([end], dtype=float)
+
+    phi = np.radians(rotation)
+    cos, sin = np.cos(phi), np.sin(phi)
+    dx, dy = (x1 - x2) / 2., (y1 - y2) / 2.
+    x1p, y1p = cos * dx + sin * dy, -sin * dx + cos * dy
+    scale = (x1p / rx) ** 2 + (y1p / ry) ** 2
+    if scale > 1:
+        rx, ry = rx * np.sqrt(scale), ry * np.sqrt(scale)
+    numerator = (rx * ry) ** 2 - (rx * y1p) ** 2 - (ry * x1p) ** 2
+    coef = np.sqrt(max(numerator, 0) / ((rx * y1p) ** 2 + (ry * x1p) ** 2))
+    if large_arc == sweep:
+        coef = -coef
+    cxp, cyp = coef * rx * y1p / ry, -coef * ry * x1p / rx
+    cx = cos * cxp - sin * cyp + (x1 + x2) / 2.
+    cy = sin * cxp + cos * cyp + (y1 + y2) / 2.
+
+    theta = np.arctan2((y1p - cyp) / ry, (x1p - cxp) / rx)
+    delta = np.arctan2((-y1p - cyp) / ry, (-x1p - cxp) / rx) - theta
+    if sweep and delta < 0:
+        delta += 2 * np.pi
+    elif not sweep and delta > 0:
+        delta -= 2 * np.pi
+
+    quarters = max(1, int(np.ceil(abs(delta) / (np.pi / 2) - 1e-9)))
+    ts = np.asarray(ts, dtype=float)
+    ts = np.concatenate([(q + ts[ts > 0]) / quarters for q in range(quarters)])
+    angles = theta + ts * delta
+    ex, ey = rx * np.cos(angles), ry * np.sin(angles)
+    return np.column_stack([cx + cos * ex - sin * ey, cy + sin * ex + cos * ey])
+
+def flatten_path(parsed_d, ts):
+    # Turns the output of svgpathparse.parsePath into a list of vertices,
+    # sampling curves at ts; the current point itself is not repeated
+    vertices = []
+    subpath_start = None
+    for cmd, _vertices in parsed_d:
+        if cmd == 'Z':
+            vertices.append(subpath_start)
+        elif cmd == 'M' or cmd == 'L':
+            vertices.append(tuple(_vertices))
+            if cmd == 'M':
+                subpath_start = vertices[-1]
+        elif cmd == 'C':
+            x1, y1, x2, y2, x3, y3 = _vertices
+            points = bezier_points([vertices[-1], (x1, y1), (x2, y2), (x3, y3)], ts)
+            vertices.extend(map(tuple, points[1:].tolist()))
+        elif cmd == 'Q':
+            x1, y1, x2, y2 = _vertices
+            points = bezier_points([vertices[-1], (x1, y1), (x2, y2)], ts)
+            vertices.extend(map(tuple, points[1:].tolist()))
+        elif cmd == 'A':
+            rx, ry, rotation, large_arc, sweep, x, y = _vertices
+            points = arc_points(vertices[-1], rx, ry, rotation, large_arc, sweep, (x, y), ts)
+            vertices.extend(map(tuple, points.tolist()))
+        else:
+            raise ValueError('not support path cmd in svg')
+    return vertices
+
+def stitch_contours(contours, tolerance, closed=None):
+    # Chains open fragments whose endpoints meet (within tolerance) into as
+    # few contours as possible. Endpoints are indexed in a grid hash keyed on
+    # the coordinates quantized to tolerance, so each lookup only inspects
+    # the 3x3 neighbouring cells instead of every other fragment. closed
+    # flags contours that are implicitly closed (polygons); they are passed
+    # through untouched. Returns the stitched contours and their closed flags.
+    def key(p):
+        return (int(round(p[0] / tolerance)), int(round(p[1] / tolerance)))
+
+    def close(p, q):
+        return abs(p[0] - q[0]) <= tolerance and abs(p[1] - q[1]) <= tolerance
+
+    if closed is None:
+        closed = [False] * len(contours)
+    fragments, implicit, loops = [], [], []
+    for contour, closed_ in zip(contours, closed):
+        if not len(contour):
+            continue
+        fragments.append(list(contour))
+        implicit.append(closed_)
+        # already a closed loop, nothing to chain onto it
+        loops.append(closed_ or (len(contour) > 2 and close(contour[0], contour[-1])))
+
+    index = {}
+    for i, fragment in enumerate(fragments):
+        if loops[i]:
+            continue
+        for end in (0, -1):
+            index.setdefault(key(fragment[end]), []).append((i, end))
+
+    used = [False] * len(fragments)
+
+    def pop_match(p):
+        kx, ky = key(p)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for i, end in index.get((kx + dx, ky + dy), ()):
+                    if not used[i] and close(fragments[i][end], p):
+                        used[i] = True
+                        return i, end
+        return None, None
+
+    def is_loop(chain):
+        return len(chain) > 2 and close(chain[0], chain[-1])
+
+    stitched, stitched_closed = [], []
+    for i, fragment in enumerate(fragments):
+        if used[i]:
+            continue
+        used[i] = True
+        if loops[i]:
+            stitched.append(fragment)
+            stitched_closed.append(implicit[i])
+            continue
+        chain = deque(fragment)
+        # grow the tail, then the head, until the chain meets itself
+        while not is_loop(chain):
+            j, end = pop_match(chain[-1])
+            if j is None:
+                break
+            piece = fragments[j] if end == 0 else fragments[j][::-1]
+            chain.extend(piece[1:])
+        while not is_loop(chain):
+            j, end = pop_match(chain[0])
+            if j is None:
+                break
+            piece = fragments[j] if end == -1 else fragments[j][::-1]
+            chain.extendleft(reversed(piece[:-1]))
+        chain = list(chain)
+        if is_loop(chain):
+            chain[-1] = chain[0]
+        stitched.append(chain)
+        stitched_closed.append(False)
+    return stitched, stitched_closed
+
+transform_re = re.compile(r'(matrix|translate|scale|rotate)\s*\(([^)]*)\)')
+
+def parse_transform(transform):
+    # Returns the 2x3 affine matrix of an svg transform attribute
+    matrix = np.array([[1., 0., 0.], [0., 1., 0.]])
+    if not transform:
+        return matrix
+    for name, args in transform_re.findall(transform):
+        args = [float(a) for a in re.split(r'[\s,]+', args.strip()) if a]
+        if name == 'matrix':
+            a, b, c, d, e, f = args
+            step = [[a, c, e], [b, d, f]]
+        elif name == 'translate':
+            tx, ty = (args + [0.])[:2]
+            step = [[1., 0., tx], [0., 1., ty]]
+        elif name == 'scale':
+            sx, sy = (args + args)[:2]
+            step = [[sx, 0., 0.], [0., sy, 0.]]
+        else:
+            angle = np.radians(args[0])
+            cx, cy = (args[1:] + [0., 0.])[:2]
+            cos, sin = np.cos(angle), np.sin(angle)
+            step = [[cos, -sin, cx - cos * cx + sin * cy], [sin, cos, cy - sin * cx - cos * cy]]
+        step = np.array(step)
+        matrix = np.hstack([matrix[:, :2].dot(step[:, :2]), matrix[:, :2].dot(step[:, 2:]) + matrix[:, 2:]])
+    return matrix
+
+def clip_polyline(vertices, rect):
+    # Clips a polyline to the rectangle (x1, y1, x2, y2) and returns the
+    # pieces that lie inside. All segments are clipped at once with a
+    # vectorized Liang-Barsky test.
+    x1, y1, x2, y2 = rect
+    points = np.asarray(vertices, dtype=float).reshape(-1, 2)
+    if len(points) < 2:
+        inside = len(points) and x1 <= points[0, 0] <= x2 and y1 <= points[0, 1] <= y2
+        return [list(vertices)] if inside else []
+
+    start, delta = points[:-1], points[1:] - points[:-1]
+    p = np.hstack([-delta[:, :1], delta[:, :1], -delta[:, 1:], delta[:, 1:]])
+    q = np.hstack([start[:, :1] - x1, x2 - start[:, :1], start[:, 1:] - y1, y2 - start[:, 1:]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = q / p
+    t0 = np.where(p < 0, ratio, 0.).max(axis=1)
+    t1 = np.where(p > 0, ratio, 1.).min(axis=1)
+    # segments that only touch the rectangle (t0 == t1) would leave zero length pieces
+    visible = (t0 < t1) & ~((p == 0) & (q < 0)).any(axis=1)
+    first = start + t0[:, None] * delta
+    last = start + t1[:, None] * delta
+
+    pieces, piece = [], None
+    for i in np.flatnonzero(visible):
+        if piece is None or t0[i] > 0 or i != previous + 1 or t1[previous] < 1:
+            piece = [tuple(first[i])]
+            pieces.append(piece)
+        piece.append(tuple(last[i]))
+        previous = i
+    # a closed contour cut open keeps its wrap-around piece in one part
+    if len(pieces) > 1 and tuple(points[0]) == tuple(points[-1]) and \
+       visible[0] and t0[0] == 0 and visible[-1] and t1[-1] == 1:
+        pieces[0][:0] = pieces.pop()[:-1]
+    return pieces
+
+def rigid_fit(source, target):
+    # Least squares rotation and translation mapping source onto target (Kabsch)
+    source_mean, target_mean = source.mean(axis=0), target.mean(axis=0)
+    u, _, vt = np.linalg.svd((source - source_mean).T.dot(target - target_mean))
+    if np.linalg.det(vt.T.dot(u.T)) < 0:
+        vt[-1] *= -1
+    linear = vt.T.dot(u.T)
+    return linear, target_mean - linear.dot(source_mean)
+
+def parse_length(value, default=0.):
+    # Leading number of an svg length such as '5', '5px' or '2.5e1'
+    match = FLOAT_RE.search(value or '')
+    return float(match.group(1)) if match else default
+
+def viewbox_transform(viewbox, width, height, preserve_aspect_ratio=None):
+    # Returns the 2x3 affine matrix mapping a viewBox onto a width x height
+    # viewport (SVG 1.1 section 7.8)
+    vx, vy, vw, vh = [float(v) for v in re.split(r'[\s,]+', viewbox.strip())]
+    width = vw if width is None else width
+    height = vh if height is None else height
+    if not vw or not vh:
+        return np.array([[1., 0., 0.], [0., 1., 0.]])
+    align, _, meet_or_slice = (preserve_aspect_ratio or 'xMidYMid meet').strip().partition(' ')
+    sx, sy = width / vw, height / vh
+    if align != 'none':
+        sx = sy = max(sx, sy) if meet_or_slice.strip() == 'slice' else min(sx, sy)
+    tx, ty = -vx * sx, -vy * sy
+    if 'xMid' in align:
+        tx += (width - vw * sx) / 2
+    elif 'xMax' in align:
+        tx += width - vw * sx
+    if 'YMid' in align:
+        ty += (height - vh * sy) / 2
+    elif 'YMax' in align:
+        ty += height - vh * sy
+    return np.array([[sx, 0., tx], [0., sy, ty]])
+
+# flattened geometry of a <symbol>/<defs> entry, shared by all its <use> instances
+Symbol = namedtuple('Symbol', ['cell_types', 'centers', 'contour_vertices', 'contour_splits', 'contour_closed'])
 
 class LayerId(object):
     id_re = re.compile(r'(\d+)[a-z]? +([a-z]+)/([a-z]+).*?', re.I)
@@ -95,35 +336,81 @@ class LayerId(object):
 
 class Caret(object):
     ts = [t/5. for t in range(6)]
-
-    def __init__(self, caret_name, spacing=6.):
+    cell_colors = [
+        ('mdplot.red', 255, 0, 0),
+        ('mdplot.green', 0, 255, 0),
+        ('mdplot.blue', 0, 0, 255),
+        ('mdplot.yellow', 255, 255, 0),
+    ]
+
+    def __init__(self, caret_name, spacing=6., crop=None):
         self.caret_name = caret_name
+        # either one (x1, y1, x2, y2) rectangle or a dict of them by layer id
+        self._crop = crop
         self._all_vertices = []
         self._cells = []
         self._contours = []
         self._layers = {}
+        self._symbols = {}
+        self._class_styles = {}
+        self._colors = {}
         self._spacing = spacing
 
     def get_vertices(self, parsed_d):
-        vertices = []
-        for cmd, _vertices in parsed_d:
-            if cmd == 'Z':
-                vertices.append(vertices[0])
-            elif cmd == 'M' or cmd == 'L':
-                vertices.append(tuple(_vertices))
-            elif cmd == 'C':
-                x0, y0, x1, y1, x2, y2 = _vertices
-                bezier = make_bezier([(x0, y0), (x1, y1), (x2, y2)])
-                vertices.extend(bezier(self.ts))
-            else:
-                raise ValueError('not support path cmd in svg')
-        return vertices
-
-    def parse_path(self, layer_id, path):
+        return flatten_path(parsed_d, self.ts)
+
+    def load_styles(self, root):
+        for style in root.iter('{http://www.w3.org/2000/svg}style'):
+            for class_, properties in parseStyleSheet(style.text).items():
+                self._class_styles.setdefault(class_, {}).update(properties)
+        self._colors = {}
+
+    def own_colors(self, element):
+        # presentation attributes are overridden by class rules, which are
+        # overridden by the inline style
+        key = (element.get('stroke'), element.get('fill'), element.get('class'), element.get('style'))
+        colors = self._colors.get(key)
+        if colors is None:
+            stroke, fill, classes, style = key
+            for class_ in (classes or '').split():
+                class_style = self._class_styles.get(class_, {})
+                stroke = class_style.get('stroke', stroke)
+                fill = class_style.get('fill', fill)
+            if style:
+                inline = parseStyleCached(style)
+                stroke = inline.get('stroke', stroke)
+                fill = inline.get('fill', fill)
+            colors = tuple(None if c == 'inherit' else c for c in (stroke, fill))
+            self._colors[key] = colors
+        return colors
+
+    def get_colors(self, element, context=None):
+        # unset colors are inherited from the enclosing groups. Content
+        # referenced by a <use> is given context=(referenced element,
+        # colors of the use): it inherits up to the referenced element and
+        # then from the use instead of from its own <defs>/<svg> ancestors.
+        stroke, fill = self.own_colors(element)
+        if context is not None and element is context[0]:
+            ancestors = []
+        else:
+            ancestors = element.iterancestors()
+        for parent in ancestors:
+            if stroke is not None and fill is not None:
+                break
+            parent_stroke, parent_fill = self.own_colors(parent)
+            stroke = parent_stroke if stroke is None else stroke
+            fill = parent_fill if fill is None else fill
+            if context is not None and parent == context[0]:
+                break
+        if context is not None:
+            stroke = context[1][0] if stroke is None else stroke
+            fill = context[1][1] if fill is None else fill
+        return stroke, fill
+
+    def classify_path(self, path, context=None):
         #print etree.tostring(path)
         p = parsePath(path.get('d'))
-        stroke = path.get('stroke')
-        fill = path.get('fill')
+        stroke, fill = self.get_colors(path, context)
         #color = stroke or fill
         #print color, p
         parsed_vertices = self.get_vertices(p)
@@ -136,23 +423,22 @@ class Caret(object):
         # this is one cell
         if stroke == '#313185' or fill == '#313185' or fill == '#00aeef' or \
            stroke == '#0000ff' or fill == '#0000ff':
-            self.add_cell(layer_id, 'mdplot.blue', parsed_vertices)
+            return 'mdplot.blue', parsed_vertices
 
         elif stroke == '#ed1c24' or fill == '#ed1c24' or stroke == '#d52e2b' or fill == '#d52e2b':
-            self.add_cell(layer_id, 'mdplot.red', parsed_vertices)
+            return 'mdplot.red', parsed_vertices
 
         elif stroke == '#fff200' or fill == '#fff200' or stroke == '#808000' or fill == '#808000':
-            self.add_cell(layer_id, 'mdplot.yellow', parsed_vertices)
+            return 'mdplot.yellow', parsed_vertices
 
         else:
             if stroke != '#000000':
                 log.warn('path stroke %s, fill %s treated as contour, vertices: %s', stroke, fill, len(parsed_vertices))
-            self.add_contour(layer_id, parsed_vertices)
+            return None, parsed_vertices
 
-    def parse_polygon(self, layer_id, polygon):
+    def classify_polygon(self, polygon, context=None):
         p = parsePath('M' + polygon.get('points'))
-        stroke = polygon.get('stroke')
-        fill = polygon.get('fill')
+        stroke, fill = self.get_colors(polygon, context)
         #color = stroke or fill
         #print color, p
         parsed_vertices = self.get_vertices(p)
@@ -165,24 +451,23 @@ class Caret(object):
         # this is one cell
         if stroke == '#313185' or fill == '#313185' or fill == '#00aeef' or \
            stroke == '#0000ff' or fill == '#0000ff':
-            self.add_cell(layer_id, 'mdplot.blue', parsed_vertices)
+            return 'mdplot.blue', parsed_vertices
 
         elif stroke == '#ed1c24' or fill == '#ed1c24' or stroke == '#d52e2b' or \
             fill == '#d52e2b' or fill == '#ff0000':
-            self.add_cell(layer_id, 'mdplot.red', parsed_vertices)
+            return 'mdplot.red', parsed_vertices
 
         elif stroke == '#fff200' or fill == '#fff200' or stroke == '#808000' or fill == '#808000':
-            self.add_cell(layer_id, 'mdplot.yellow', parsed_vertices)
+            return 'mdplot.yellow', parsed_vertices
 
         else:
             if stroke != '#000000':
                 log.warn('polygon stroke %s fill %s treated as contour, vertices %s', stroke, fill, len(parsed_vertices))
-            self.add_contour(layer_id, parsed_vertices)
+            return None, parsed_vertices
 
-    def parse_polyline(self, layer_id, polyline):
+    def classify_polyline(self, polyline, context=None):
         p = parsePath('M' + polyline.get('points'))
-        stroke = polyline.get('stroke')
-        fill = polyline.get('fill')
+        stroke, fill = self.get_colors(polyline, context)
         #color = stroke or fill
         #print color, p
         parsed_vertices = self.get_vertices(p)
@@ -195,24 +480,165 @@ class Caret(object):
         # this is one cell
         if stroke == '#313185' or fill == '#313185' or fill == '#00aeef' or \
            stroke == '#0000ff' or fill == '#0000ff' or stroke == '#3a53a4':
-            self.add_cell(layer_id, 'mdplot.blue', parsed_vertices)
+            return 'mdplot.blue', parsed_vertices
         elif stroke == '#ed1c24' or fill == '#ed1c24' or stroke == '#d52e2b' or \
             fill == '#d52e2b' or fill == '#ff0000':
-            self.add_cell(layer_id, 'mdplot.red', parsed_vertices)
+            return 'mdplot.red', parsed_vertices
 
         elif stroke == '#fff200' or fill == '#fff200' or stroke == '#808000' or fill == '#808000':
-            self.add_cell(layer_id, 'mdplot.yellow', parsed_vertices)
+            return 'mdplot.yellow', parsed_vertices
         elif stroke == '#00884b' and len(parsed_vertices) > 5:
-            self.add_contour(layer_id, parsed_vertices)
+            return None, parsed_vertices
         else:
             if stroke != '#000000':
                 log.warn('polyline stroke %s fill %s treated as contour, vertices %s', stroke, fill, len(parsed_vertices))
-            self.add_contour(layer_id, parsed_vertices)
+            return None, parsed_vertices
+
+    def classify(self, element, context=None):
+        tag = etree.QName(element).localname
+        if tag == 'path':
+            return self.classify_path(element, context)
+        elif tag == 'polygon':
+            return self.classify_polygon(element, context)
+        elif tag == 'polyline':
+            return self.classify_polyline(element, context)
+        raise ValueError('not support element in svg: %s' % tag)
+
+    def add_shape(self, layer_id, type_, vertices, closed=False):
+        if type_ is None:
+            self.add_contour(layer_id, vertices, closed)
+        else:
+            self.add_cell(layer_id, type_, vertices)
+
+    def parse_path(self, layer_id, path):
+        self.add_shape(layer_id, *self.classify_path(path))
+
+    def parse_polygon(self, layer_id, polygon):
+        # polygons are implicitly closed, their last vertex is not repeated
+        self.add_shape(layer_id, *self.classify_polygon(polygon), closed=True)
+
+    def parse_polyline(self, layer_id, polyline):
+        self.add_shape(layer_id, *self.classify_polyline(polyline))
+
+    def get_symbol(self, href, element, inherited=(None, None)):
+        # A referenced <symbol>/<defs> entry is parsed and flattened only once
+        # per set of colors it inherits from its <use>; every <use> of it
+        # afterwards reuses the cached arrays.
+        key = (href,) + tuple(inherited)
+        symbol = self._symbols.get(key)
+        if symbol is not None:
+            return symbol
+
+        cell_types, centers, contours, contour_closed = [], [], [], []
+        for child in element.iter():
+            if not isinstance(child.tag, basestring) or \
+               etree.QName(child).localname not in ('path', 'polygon', 'polyline'):
+                continue
+            type_, vertices = self.classify(child, (element, inherited))
+            if type_ is None:
+                contours.append(vertices)
+                contour_closed.append(etree.QName(child).localname == 'polygon')
+            else:
+                cell_types.append(type_)
+                centers.append(np.mean(vertices, axis=0))
+
+        if contours:
+            contour_vertices = np.concatenate([np.asarray(c, dtype=float) for c in contours])
+            contour_splits = np.cumsum([len(c) for c in contours])[:-1]
+        else:
+            contour_vertices = np.zeros((0, 2))
+            contour_splits = []
+        symbol = Symbol(cell_types, np.asarray(centers, dtype=float).reshape(-1, 2),
+                        contour_vertices, contour_splits, contour_closed)
+        log.info('parsed symbol %s cells: %s contours: %s', href, len(cell_types), len(contours))
+        self._symbols[key] = symbol
+        return symbol
+
+    def parse_use(self, layer_id, use, elements_by_id):
+        href = use.get('{http://www.w3.org/1999/xlink}href') or use.get('href')
+        if not href or not href.startswith('#') or href[1:] not in elements_by_id:
+            log.warn('use references unknown element %s, skipped', href)
+            return
+        element = elements_by_id[href[1:]]
+        symbol = self.get_symbol(href, element, self.get_colors(use))
+
+        # <use x y> is a translation applied before the use's own transform,
+        # a <symbol> viewBox is then fitted into the use's width x height
+        matrix = parse_transform(use.get('transform'))
+        offset = np.array([parse_length(use.get('x')), parse_length(use.get('y'))])
+        linear, translate = matrix[:, :2], matrix[:, 2] + matrix[:, :2].dot(offset)
+        if etree.QName(element).localname == 'symbol' and element.get('viewBox'):
+            width = use.get('width') or element.get('width')
+            height = use.get('height') or element.get('height')
+            viewbox = viewbox_transform(element.get('viewBox'),
+                                        parse_length(width, None) if width else None,
+                                        parse_length(height, None) if height else None,
+                                        element.get('preserveAspectRatio'))
+            linear, translate = linear.dot(viewbox[:, :2]), linear.dot(viewbox[:, 2]) + translate
+
+        centers = symbol.centers.dot(linear.T) + translate
+        for type_, center in zip(symbol.cell_types, centers.tolist()):
+            self.add_cell_center(layer_id, type_, tuple(center))
+        if len(symbol.contour_vertices):
+            vertices = symbol.contour_vertices.dot(linear.T) + translate
+            for contour, closed in zip(np.split(vertices, symbol.contour_splits), symbol.contour_closed):
+                self.add_contour(layer_id, map(tuple, contour.tolist()), closed)
+
+    def get_crop(self, layer_id):
+        if isinstance(self._crop, dict):
+            return self._crop.get(layer_id)
+        return self._crop
+
+    def bounding_boxes(self, elements):
+        # polygons and polylines are bounded straight from their raw point
+        # lists in one batch, paths through svgpathparse.extractBoundingBox
+        bboxes = np.zeros((len(elements), 4))
+        points, counts, rows = [], [], []
+        for row, element in enumerate(elements):
+            tag = etree.QName(element).localname
+            coords = FLOAT_RE.findall(element.get('points') or '') if tag in ('polygon', 'polyline') else []
+            if len(coords) > 1:
+                points.extend(coords[:len(coords) // 2 * 2])
+                counts.append(len(coords) // 2)
+                rows.append(row)
+            elif tag == 'path':
+                bboxes[row] = extractBoundingBox(element.get('d'))
+            else:
+                bboxes[row] = (-np.inf, -np.inf, np.inf, np.inf)
+        if rows:
+            points = np.array(points, dtype=float).reshape(-1, 2)
+            starts = np.cumsum([0] + counts[:-1])
+            bboxes[rows, :2] = np.minimum.reduceat(points, starts)
+            bboxes[rows, 2:] = np.maximum.reduceat(points, starts)
+        return bboxes
+
+    def prefilter(self, layer_id, elements):
+        # drops the elements whose bounding box misses the crop rectangle
+        crop = self.get_crop(layer_id)
+        if crop is None or not len(elements):
+            return elements
+        bboxes = self.bounding_boxes(elements)
+        x1, y1, x2, y2 = crop
+        keep = (bboxes[:, 0] <= x2) & (bboxes[:, 2] >= x1) & (bboxes[:, 1] <= y2) & (bboxes[:, 3] >= y1)
+        bounded = keep & np.isfinite(bboxes).all(axis=1)
+        log.info('crop layer %s kept %s of %s elements, extent %s', layer_id, keep.sum(), len(elements),
+                 _mergeBoundingBox(bboxes[bounded]) if bounded.any() else None)
+        return [element for element, kept in zip(elements, keep) if kept]
+
+    def add_layer(self, layer_id):
+        # a layer keeps its section index even when nothing in it survives the crop
+        return self._layers.setdefault(layer_id, {})
 
     def add_cell(self, layer_id, type_, vertices):
-        log.debug('add cell type %s to layer %s', type_, layer_id)
         x_coords, y_coords = zip(*vertices)
         center = (sum(x_coords) / len(x_coords), sum(y_coords) / len(y_coords))
+        self.add_cell_center(layer_id, type_, center)
+
+    def add_cell_center(self, layer_id, type_, center):
+        crop = self.get_crop(layer_id)
+        if crop is not None and not (crop[0] <= center[0] <= crop[2] and crop[1] <= center[1] <= crop[3]):
+            return
+        log.debug('add cell type %s to layer %s', type_, layer_id)
         layer = self._layers.get(layer_id, {})
         self._layers.setdefault(layer_id, layer)
 
@@ -222,20 +648,110 @@ class Caret(object):
         cells.append([type_, center])
         self._all_vertices.append([center[0], center[1]])
 
-    def add_contour(self, layer_id, vertices):
+    def add_contour(self, layer_id, vertices, closed=False):
+        crop = self.get_crop(layer_id)
+        if crop is not None:
+            x_coords, y_coords = zip(*vertices)
+            if min(x_coords) < crop[0] or max(x_coords) > crop[2] or \
+               min(y_coords) < crop[1] or max(y_coords) > crop[3]:
+                # straddles the crop boundary, the pieces left are open
+                if closed:
+                    vertices = list(vertices) + [vertices[0]]
+                for piece in clip_polyline(vertices, crop):
+                    self._add_contour(layer_id, piece)
+                return
+        self._add_contour(layer_id, vertices, closed)
+
+    def _add_contour(self, layer_id, vertices, closed=False):
         log.debug('add contour vertices %s to layer %s', vertices, layer_id)
         layer = self._layers.get(layer_id, {})
         self._layers.setdefault(layer_id, layer)
 
         contours = layer.get('contours', [])
         layer.setdefault('contours', contours)
+        # whether each contour is implicitly closed, in step with contours
+        closed_flags = layer.get('closed', [])
+        layer.setdefault('closed', closed_flags)
 
         contours.append(vertices)
+        closed_flags.append(closed)
         self._all_vertices.extend(vertices)
 
+    def stitch_layers(self, tolerance):
+        for layer_id, layer in self._layers.items():
+            contours = layer.get('contours', [])
+            if not contours:
+                continue
+            stitched, closed = stitch_contours(contours, tolerance, layer.get('closed'))
+            log.info('stitched contours for layer %s: %s -> %s', layer_id, len(contours), len(stitched))
+            layer['contours'] = stitched
+            layer['closed'] = closed
+
+    def layer_points(self, layer):
+        points = [v for contour in layer.get('contours', []) for v in contour]
+        points.extend(center for type_, center in layer.get('cells', []))
+        return np.asarray(points, dtype=float).reshape(-1, 2)
+
+    def transform_layer(self, layer, linear, translate):
+        contours = layer.get('contours', [])
+        if contours:
+            vertices = np.concatenate([np.asarray(c, dtype=float).reshape(-1, 2) for c in contours])
+            vertices = vertices.dot(linear.T) + translate
+            splits = np.cumsum([len(c) for c in contours])[:-1]
+            layer['contours'] = [map(tuple, c.tolist()) for c in np.split(vertices, splits)]
+        cells = layer.get('cells', [])
+        if cells:
+            centers = np.asarray([center for type_, center in cells], dtype=float)
+            centers = centers.dot(linear.T) + translate
+            layer['cells'] = [[type_, tuple(center)] for (type_, _), center in zip(cells, centers.tolist())]
+
+    def register_layers(self, center='centroid', rigid=False, samples=200, iterations=10):
+        # Moves every layer's centroid (or bounding box center) onto a common
+        # origin, then optionally aligns each layer to the previous one with
+        # a rigid ICP on subsampled vertices.
+        previous = None
+        for layer_id in sorted(self._layers.keys(), key=LayerId):
+            layer = self._layers[layer_id]
+            points = self.layer_points(layer)
+            if not len(points):
+                continue
+            if center == 'bbox':
+                origin = (points.min(axis=0) + points.max(axis=0)) / 2
+            else:
+                origin = points.mean(axis=0)
+            linear, translate = np.eye(2), np.zeros(2)
+
+            if len(points) > samples:
+                points = points[np.linspace(0, len(points) - 1, samples).astype(int)]
+            points = points - origin
+            if rigid and previous is not None:
+                for _ in range(iterations):
+                    moved = points.dot(linear.T) + translate
+                    distances = ((moved[:, None, :] - previous[None, :, :]) ** 2).sum(axis=2)
+                    matched = previous[distances.argmin(axis=1)]
+                    step_linear, step_translate = rigid_fit(moved, matched)
+                    linear = step_linear.dot(linear)
+                    translate = step_linear.dot(translate) + step_translate
+                    if np.allclose(step_translate, 0, atol=1e-6) and np.allclose(step_linear, np.eye(2), atol=1e-9):
+                        break
+                log.info('registered layer %s rotation: %.3f deg', layer_id,
+                         np.degrees(np.arctan2(linear[1, 0], linear[0, 0])))
+            previous = points.dot(linear.T) + translate
+
+            # the registration of the subsample is relative to the layer origin
+            self.transform_layer(layer, linear, translate - linear.dot(origin))
+            log.info('registered layer %s offset: %s', layer_id, -origin)
+
+        self._all_vertices = []
+        for layer in self._layers.values():
+            self._all_vertices.extend(self.layer_points(layer).tolist())
+
     def get_offsets(self):
         #x_series = [v[0] for v in self._all_vertices]
         #y_series = [v[1] for v in self._all_vertices]
+        if not self._all_vertices:
+            log.warn('no vertices left to center on, using offsets 0, 0')
+            return 0, 0
         x_series, y_series = zip(*self._all_vertices)
         if all([len(x_series), len(y_series)]):
             offset_x = (min(x_series) + max(x_series)) / 2
@@ -336,35 +852,100 @@ class Caret(object):
             ['csvf-section-start', 'Colors', '9', '', '', '', '', '', ''],
             fieldnames
         ])
-        cc.append(['mdplot.red', '255', '0', '0', '255', '3.0', '1.0', 'POINT', ''])
-        cc.append(['mdplot.green', '0', '255', '0', '255', '3.0', '1.0', 'POINT', ''])
-        cc.append(['mdplot.blue', '0', '0', '255', '255', '3.0', '1.0', 'POINT', ''])
-        cc.append(['mdplot.yellow', '255', '255', '0', '255', '3.0', '1.0', 'POINT', ''])
+        for name, red, green, blue in self.cell_colors:
+            cc.append([name, str(red), str(green), str(blue), '255', '3.0', '1.0', 'POINT', ''])
         cc.append(['csvf-section-end', 'Colors', '', '', '', '', '', '', ''])
         with open(os.path.join('caret', self.caret_name + '.contour_cell_color'), 'wb') as fout:
             writer = csv.writer(fout)
             writer.writerows(cc)
 
+    def dump_ply(self):
+        # binary PLY point cloud of the cells, colored by their mdplot class
+        offset_x, offset_y = self.get_offsets()
+        colors = dict((name, (red, green, blue)) for name, red, green, blue in self.cell_colors)
+        centers, depths, types = [], [], []
+        for layer_idx, layer_id in enumerate(sorted(self._layers.keys(), key=LayerId)):
+            for type_, center in self._layers[layer_id].get('cells', []):
+                centers.append(center)
+                depths.append(layer_idx)
+                types.append(type_)
+
+        points = np.zeros(len(centers), dtype=[
+            ('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+        if centers:
+            centers = np.asarray(centers, dtype=float)
+            points['x'] = centers[:, 0] - offset_x
+            points['y'] = offset_y - centers[:, 1]
+            points['z'] = np.asarray(depths) * self._spacing
+            rgb = np.array([colors.get(type_, (255, 255, 255)) for type_ in types], dtype='u1')
+            points['red'], points['green'], points['blue'] = rgb.T
+
+        header = '\n'.join([
+            'ply',
+            'format binary_little_endian 1.0',
+            'comment %s cells' % self.caret_name,
+            'element vertex %s' % len(points),
+            'property float x',
+            'property float y',
+            'property float z',
+            'property uchar red',
+            'property uchar green',
+            'property uchar blue',
+            'end_header',
+        ])
+        with open(os.path.join('caret', self.caret_name + '.ply'), 'wb') as fout:
+            fout.write(header + '\n')
+            fout.write(points.tobytes())
+
+    def dump_vtk(self):
+        # legacy binary VTK polydata, one polyline per contour with its section as cell scalar
+        offset_x, offset_y = self.get_offsets()
+        vertices, counts, depths = [], [], []
+        for layer_idx, layer_id in enumerate(sorted(self._layers.keys(), key=LayerId)):
+            for contour in self._layers[layer_id].get('contours', []):
+                vertices.extend(contour)
+                counts.append(len(contour))
+                depths.append(layer_idx)
+
+        points = np.zeros((len(vertices), 3), dtype='>f4')
+        if vertices:
+            vertices = np.asarray(vertices, dtype=float)
+            points[:, 0] = vertices[:, 0] - offset_x
+            points[:, 1] = offset_y - vertices[:, 1]
+            points[:, 2] = np.repeat(depths, counts) * self._spacing
+        # each line is stored as its vertex count followed by its point indices
+        starts = np.cumsum([0] + counts[:-1]).astype(int)
+        lines = np.insert(np.arange(len(points)), starts, counts).astype('>i4')
+
+        with open(os.path.join('caret', self.caret_name + '.vtk'), 'wb') as fout:
+            fout.write('# vtk DataFile Version 3.0\n')
+            fout.write('%s contours\n' % self.caret_name)
+            fout.write('BINARY\n')
+            fout.write('DATASET POLYDATA\n')
+            fout.write('POINTS %s float\n' % len(points))
+            fout.write(points.tobytes())
+            fout.write('\nLINES %s %s\n' % (len(counts), len(lines)))
+            fout.write(lines.tobytes())
+            fout.write('\nCELL_DATA %s\n' % len(counts))
+            fout.write('SCALARS section int 1\n')
+            fout.write('LOOKUP_TABLE default\n')
+            fout.write(np.asarray(depths, dtype='>i4').tobytes())
+            fout.write('\n')
+
 class Main(object):
-    def __init__(self, spacing=6.):
+    def __init__(self, spacing=6., stitch_tolerance=None, export_3d=False, register=None, register_rigid=False,
+                 crop=None):
         "initialize"
         self.ts = [t/5. for t in range(6)]
         self._spacing = spacing
+        self._stitch_tolerance = stitch_tolerance
+        self._register = register
+        self._register_rigid = register_rigid
+        self._export_3d = export_3d
+        self._crop = crop
 
     def get_vertices(self, parsed_d):
-        vertices = []
-        for cmd, _vertices in parsed_d:
-            if cmd == 'Z':
-                vertices.append(vertices[0])
-            elif cmd == 'M' or cmd == 'L':
-                vertices.append(tuple(_vertices))
-            elif cmd == 'C':
-                x0, y0, x1, y1, x2, y2 = _vertices
-                bezier = make_bezier([(x0, y0), (x1, y1), (x2, y2)])
-                vertices.extend(bezier(self.ts))
-            else:
-                raise ValueError('not support path cmd in svg')
-        return vertices
+        return flatten_path(parsed_d, self.ts)
 
     def run(self, fn_base):
         with open(fn_base + '.svg', 'rb') as f:
@@ -382,7 +963,11 @@ class Main(object):
             'label': '{' + nsmap['inkscape'] + '}label',
         }
         #for x in root.xpath('.//svg:svg', namespaces=nsmap):
-        caret = Caret(fn_base, self._spacing)
+        caret = Caret(fn_base, self._spacing, self._crop)
+        caret.load_styles(root)
+        elements_by_id = dict((e.get('id'), e) for e in root.xpath('//*[@id]'))
+        # geometry inside <defs>/<symbol> only shows up through <use>
+        not_def = '[not(ancestor::svg:defs) and not(ancestor::svg:symbol)]'
 
         for g in root.xpath('./svg:g', namespaces=nsmap):
             id_ = re.sub(r'_x([\da-fA-F][\da-fA-F])_', lambda match_o: chr(int(match_o.group(1), 16)), g.get('id'))
@@ -394,23 +979,35 @@ class Main(object):
                 slide = matches.group(1)
                 section_suffix = matches.group(2)
                 depth = slide
-                for path in g.xpath('.//svg:path', namespaces=nsmap):
+                if caret.get_crop(layer_id) is not None:
+                    caret.add_layer(layer_id)
+                for path in caret.prefilter(layer_id, g.xpath('.//svg:path' + not_def, namespaces=nsmap)):
                     log.debug('parse path %s', etree.tostring(path))
                     caret.parse_path(layer_id, path)
 
-                for polygon in g.xpath('.//svg:polygon', namespaces=nsmap):
+                for polygon in caret.prefilter(layer_id, g.xpath('.//svg:polygon' + not_def, namespaces=nsmap)):
                     caret.parse_polygon(layer_id, polygon)
 
-                for polyline in g.xpath('.//svg:polyline', namespaces=nsmap):
+                for polyline in caret.prefilter(layer_id, g.xpath('.//svg:polyline' + not_def, namespaces=nsmap)):
                     caret.parse_polyline(layer_id, polyline)
+
+                for use in caret.prefilter(layer_id, g.xpath('.//svg:use' + not_def, namespaces=nsmap)):
+                    caret.parse_use(layer_id, use, elements_by_id)
             else:
                 if id_ == 'Background':
                     continue
                 else:
                     raise ValueError('cannot parse layer id: %s', id_)
+        if self._stitch_tolerance:
+            caret.stitch_layers(self._stitch_tolerance)
+        if self._register:
+            caret.register_layers(self._register, rigid=self._register_rigid)
         caret.dump_cell_color()
         caret.dump_cells()
         caret.dump_contours()
+        if self._export_3d:
+            caret.dump_ply()
+            caret.dump_vtk()
 
 
 
@@ -62,6 +62,11 @@ def lexPath(d):
     delim = re.compile(r'[ \t\r\n,]+')
     command = re.compile(r'[MLHVCSQTAZmlhvcsqtaz]')
     parameter = re.compile(r'(([-+]?[0-9]+(\.[0-9]*)?|[-+]?\.[0-9]+)([eE][-+]?[0-9]+)?)')
+    # arc flags are single characters and may be written without
+    # separators, eg. "a5 5 0 0110 0"
+    flag = re.compile(r'[01]')
+    lastCommand = ''
+    paramIndex = 0
     while 1:
         m = delim.match(d, offset)
         if m:
@@ -71,11 +76,17 @@ def lexPath(d):
         m = command.match(d, offset)
         if m:
             yield [d[offset:m.end()], True]
+            lastCommand = d[offset:m.end()].upper()
+            paramIndex = 0
             offset = m.end()
             continue
-        m = parameter.match(d, offset)
+        if lastCommand == 'A' and paramIndex % 7 in (3, 4):
+            m = flag.match(d, offset)
+        else:
+            m = parameter.match(d, offset)
         if m:
             yield [d[offset:m.end()], False]
+            paramIndex += 1
             offset = m.end()
             continue
         #TODO: create new exception
@@ -274,9 +285,34 @@ def extractBoundingBox(pathString):
     pathList = parsePath(pathString)
     pathArr = []
 
+    pen = subPathStart = (0.0, 0.0)
     for pointList in pathList:
-        for point in chunks(pointList[1],2):
-            pathArr.append(point)
+        if pointList[0] == 'A':
+            # radii, rotation and flags are not coordinates; the arc stays
+            # within its diameter of the end point once the radii are scaled
+            # up to fit the chord (SVG 1.1 implementation notes F.6.6)
+            rx, ry, rotation, x, y = abs(pointList[1][0]), abs(pointList[1][1]), pointList[1][2], \
+                pointList[1][5], pointList[1][6]
+            phi = np.radians(rotation)
+            dx, dy = (pen[0] - x) / 2., (pen[1] - y) / 2.
+            x1p = np.cos(phi) * dx + np.sin(phi) * dy
+            y1p = -np.sin(phi) * dx + np.cos(phi) * dy
+            if rx and ry:
+                scale = np.sqrt(max(1., (x1p / rx) ** 2 + (y1p / ry) ** 2))
+                reach = 2 * max(rx, ry) * scale
+            else:
+                reach = 0.
+            pathArr.extend([[x - reach, y - reach], [x + reach, y + reach]])
+        else:
+            for point in chunks(pointList[1],2):
+                pathArr.append(point)
+
+        if pointList[0] == 'Z':
+            pen = subPathStart
+        elif pointList[1]:
+            pen = tuple(pointList[1][-2:])
+            if pointList[0] == 'M':
+                subPathStart = pen
 
     # Here we have list of string containing pairs of coordinates separated by
     # comma: ['1,1', '3,3', ...]. We need to extract numbers from thode strings
@@ -342,6 +378,51 @@ def parseStyle(s):
     else:
       return dict([i.split(":") for i in s.split(";") if len(i)])
 
+_styleCache = {}
+
+def parseStyleCached(s):
+    """
+    Memoized version of L{parseStyle<svgpathparse.parseStyle>} keyed on the raw
+    style string. Property names and values are stripped of whitespace and
+    only the first colon of a declaration separates them, so values such as
+    C{url(data:...)} are kept whole.
+
+    @type  s: string
+    @param s: value of an inline style attribute
+
+    @return: dictionary of style properties. The dictionary is shared between
+             callers and must not be modified.
+    """
+    try:
+        return _styleCache[s]
+    except KeyError:
+        # values such as url(data:...) or quoted fonts may contain colons
+        style = dict((k.strip(), v.strip()) for k, v in
+                     (i.split(":", 1) for i in (s or '').split(";") if ":" in i))
+        _styleCache[s] = style
+        return style
+
+def parseStyleSheet(css):
+    """
+    Create a dictionary of class selectors from the content of a C{<style>}
+    element, eg. C{.st0{fill:#FFFFFF;stroke:#000000;}}. Selectors other than
+    plain class selectors are ignored.
+
+    @type  css: string
+    @param css: content of a style element
+
+    @return: dictionary mapping class names to dictionaries of style properties
+    """
+    classes = {}
+    css = re.sub(r'/\*.*?\*/', '', css or '', flags=re.S)
+    for selectors, declarations in re.findall(r'([^{}]+)\{([^}]*)\}', css):
+        style = parseStyleCached(declarations.strip())
+        for selector in selectors.split(','):
+            selector = selector.strip()
+            if re.match(r'^\.[-\w]+$', selector):
+                classes.setdefault(selector[1:], {}).update(style)
+    return classes
+
 def formatStyle(a):
     """Format an inline style attribute from a dictionary
 